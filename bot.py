@@ -1,92 +1,295 @@
+import asyncio
 import json
+import logging
 import os
 import re
+import sqlite3
 import threading
+import time
+from dataclasses import dataclass, field, fields
 from datetime import datetime, timezone
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 import requests  # nécessite: pip install requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from telegram import Update
+try:
+    import orjson  # dans requirements.txt ; repli sur json si absent (sérialisation plus rapide)
+except ImportError:
+    orjson = None
+
+from telegram import Bot, Update
+from telegram.error import RetryAfter
 from telegram.ext import Application, MessageHandler, CommandHandler, ContextTypes, filters
 
+logger = logging.getLogger("ulysse")
+
 TOKEN = os.getenv("TOKEN")
 ANNOUNCE_CHANNEL_ID = -1003199435152  # ID du canal annonces
 DISCUSSION_CHAT_ID = -1003203628589   # ID du canal de discussion
-TRADES_FILE = "trades.json"
+TRADES_FILE = "trades.json"  # ancien format, migré automatiquement vers TRADES_DB
+TRADES_DB = "trades.db"
+CREATED_DISPLAY_FORMAT = "%Y-%m-%d %H:%M:%S"  # date affichée par /trades (UTC)
+COINGECKO_IDS_FILE = "coingecko_ids.json"  # cache disque des résolutions /search
 
 
 # ---------- Stockage ----------
 
+def json_loads(raw: bytes | str) -> Any:
+    """Décode du JSON avec orjson si disponible, sinon avec le module json standard."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
 def load_trades() -> List[Dict[str, Any]]:
+    """Lit l'ancien trades.json (utilisé uniquement pour migrer vers SQLite)."""
     if not os.path.exists(TRADES_FILE):
         return []
-    with open(TRADES_FILE, "r", encoding="utf-8") as f:
+    with open(TRADES_FILE, "rb") as f:
         try:
-            return json.load(f)
-        except json.JSONDecodeError:
+            return json_loads(f.read())
+        except json.JSONDecodeError:  # orjson.JSONDecodeError en hérite
             return []
 
 
-def save_trades(trades: List[Dict[str, Any]]) -> None:
-    with open(TRADES_FILE, "w", encoding="utf-8") as f:
-        json.dump(trades, f, ensure_ascii=False, indent=2, default=str)
-
-
-def add_trade(trade: Dict[str, Any]) -> None:
-    trades = load_trades()
-    trades.append(trade)
-    save_trades(trades)
-
-
-def clear_all_trades() -> None:
-    """Supprime tous les trades."""
-    save_trades([])
-
-
-def clear_trades_by_symbol(symbol: str) -> int:
+@dataclass(slots=True)
+class Trade:
+    """Un trade ouvert (un call du canal annonces)."""
+
+    pair: str
+    side: str
+    entry: float | None
+    entries: List[float]
+    sl: float | None
+    tps: List[float] = field(default_factory=list)
+    hit_tps_mask: int = 0       # bit i à 1 = TP d'index i touché
+    hit_entries_mask: int = 0   # bit i à 1 = PE d'index i touchée
+    sl_note: str = ""
+    created_at: str = ""
+    created_at_display: str = ""
+    origin_message_id: int = 0
+    id: int | None = None       # id SQLite, None tant que le trade n'est pas inséré
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Champs persistés dans la colonne `data` (sans l'id SQLite)."""
+        return {f: getattr(self, f) for f in _TRADE_DATA_FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], trade_id: int | None = None) -> "Trade":
+        """Construit un Trade depuis un dict stocké ; les clés inconnues sont ignorées."""
+        known = {k: v for k, v in data.items() if k in _TRADE_DATA_FIELDS}
+        known["pair"] = str(known.get("pair") or "")
+        known["side"] = str(known.get("side") or "")
+        known.setdefault("entry", None)
+        known["entries"] = known.get("entries") or []
+        known.setdefault("sl", None)
+        known["tps"] = known.get("tps") or []
+        return cls(**known, id=trade_id)
+
+
+_TRADE_DATA_FIELDS = tuple(f.name for f in fields(Trade) if f.name != "id")
+
+
+def dump_trade(trade: Trade) -> str:
+    """Sérialise un trade pour la colonne `data` (sans son id SQLite)."""
+    data = trade.to_dict()
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def upgrade_trade(trade: Dict[str, Any]) -> bool:
     """
-    Supprime les trades dont la paire contient le symbole donné (ex: 'SOL').
-    Renvoie le nombre de trades supprimés.
+    Met à niveau un trade enregistré avec un ancien schéma :
+    - listes `hit_tps` / `hit_entries` -> bitmasks
+    - `created_at_display` manquant -> calculé une fois depuis `created_at`
+    Renvoie True si le trade a été modifié.
     """
-    sym = symbol.upper()
-    trades = load_trades()
-    kept: List[Dict[str, Any]] = []
-    removed = 0
-    for t in trades:
-        pair = str(t.get("pair", "")).upper()
-        if sym in pair:
-            removed += 1
-        else:
-            kept.append(t)
-    save_trades(kept)
-    return removed
+    changed = False
+    for legacy, mask_key in (("hit_tps", "hit_tps_mask"), ("hit_entries", "hit_entries_mask")):
+        if legacy in trade:
+            trade[mask_key] = sum(1 << i for i in set(trade.pop(legacy) or []))
+            changed = True
+
+    created = trade.get("created_at")
+    if created and "created_at_display" not in trade:
+        try:
+            display = datetime.fromisoformat(created).strftime(CREATED_DISPLAY_FORMAT)
+        except (TypeError, ValueError):
+            display = str(created).split(".")[0].replace("T", " ")
+        trade["created_at_display"] = display
+        changed = True
+    return changed
 
 
-def get_open_trades(limit: int = 10) -> List[Dict[str, Any]]:
+class TradeStore:
     """
-    Renvoie les trades enregistrés (on ne stocke que les trades ouverts).
+    Trades ouverts gardés en mémoire (chargés une seule fois au démarrage) et
+    persistés dans SQLite, une ligne par trade.
+    - ajout / suppression : INSERT / DELETE immédiats, sans réécrire les autres trades
+    - modification en place : mark_dirty(trade), puis UPDATE groupé au prochain flush()
     """
-    trades = load_trades()
-    return trades[-limit:]
+
+    def __init__(self, path: str = TRADES_DB) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS trades("
+            "id INTEGER PRIMARY KEY, pair TEXT, side TEXT, data JSON, created_at TEXT)"
+        )
+        self._trades: List[Trade] = []
+        self._dirty_ids: set[int] = set()
+        # symbole de base ('BTC' pour 'BTC/USDT') -> trades, du plus ancien au plus récent
+        self._by_symbol: Dict[str, List[Trade]] = {}
+
+        for trade_id, raw in self._db.execute("SELECT id, data FROM trades ORDER BY id"):
+            data = json_loads(raw)
+            if upgrade_trade(data):
+                self._dirty_ids.add(trade_id)
+            self._trades.append(Trade.from_dict(data, trade_id))
+
+        # Migration one-shot depuis l'ancien trades.json, marquée par PRAGMA user_version
+        # pour qu'une table vidée (/clear, trades fermés) ne ré-importe pas l'ancien fichier.
+        if self._db.execute("PRAGMA user_version").fetchone()[0] < 1:
+            legacy = load_trades() if not self._trades else []
+            with self._db:
+                self._db.execute("BEGIN")
+                for data in legacy:
+                    upgrade_trade(data)
+                    self._insert(Trade.from_dict(data))
+                self._db.execute("PRAGMA user_version = 1")
+            if legacy:
+                os.replace(TRADES_FILE, TRADES_FILE + ".migrated")
+
+        self._reindex()
+
+    @staticmethod
+    def _base_symbol(trade: Trade) -> str:
+        return trade.pair.upper().split("/")[0]
+
+    def _reindex(self) -> None:
+        self._by_symbol = {}
+        for t in self._trades:
+            self._by_symbol.setdefault(self._base_symbol(t), []).append(t)
+
+    def _insert(self, trade: Trade) -> None:
+        cur = self._db.execute(
+            "INSERT INTO trades(pair, side, data, created_at) VALUES (?, ?, ?, ?)",
+            (trade.pair, trade.side, dump_trade(trade), trade.created_at),
+        )
+        trade.id = cur.lastrowid
+        self._trades.append(trade)
+        self._by_symbol.setdefault(self._base_symbol(trade), []).append(trade)
+
+    def add_trade(self, trade: Trade) -> None:
+        with self._lock:
+            self._insert(trade)
+
+    def clear_all_trades(self) -> None:
+        """Supprime tous les trades."""
+        with self._lock:
+            self._db.execute("DELETE FROM trades")
+            self._trades = []
+            self._by_symbol = {}
+            self._dirty_ids.clear()
+
+    def clear_trades_by_symbol(self, symbol: str) -> int:
+        """
+        Supprime les trades dont la paire contient le symbole donné (ex: 'SOL').
+        Renvoie le nombre de trades supprimés.
+        """
+        sym = symbol.upper()
+        with self._lock:
+            self._db.execute("DELETE FROM trades WHERE instr(UPPER(pair), ?) > 0", (sym,))
+            kept = [t for t in self._trades if sym not in t.pair.upper()]
+            removed = len(self._trades) - len(kept)
+            self._trades = kept
+            self._reindex()
+        return removed
+
+    def apply_tick(self, updated: List[Trade], closed: List[Trade]) -> None:
+        """
+        Enregistre en une fois le résultat d'un passage du job de prix :
+        `updated` ont été modifiés en place (UPDATE au prochain flush),
+        `closed` sont retirés (DELETE dans une seule transaction).
+        """
+        closed_ids = {t.id for t in closed}
+        with self._lock:
+            self._dirty_ids.update(t.id for t in updated)
+            if not closed_ids:
+                return
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("DELETE FROM trades WHERE id = ?", [(i,) for i in closed_ids])
+            self._trades = [t for t in self._trades if t.id not in closed_ids]
+            self._dirty_ids -= closed_ids
+            self._reindex()
+
+    def find_last_by_symbol(self, symbol: str) -> Trade | None:
+        """
+        Renvoie le trade le plus récent pour ce symbole :
+        d'abord par symbole de base exact (lookup dict), sinon le dernier
+        trade dont la paire contient le symbole.
+        """
+        sym = symbol.upper()
+        with self._lock:
+            by_base = self._by_symbol.get(sym)
+            if by_base:
+                return by_base[-1]
+            return next(
+                (t for t in reversed(self._trades) if sym in t.pair.upper()),
+                None,
+            )
+
+    def get_open_trades(self, limit: int | None = None) -> List[Trade]:
+        """
+        Renvoie les trades enregistrés (on ne stocke que les trades ouverts).
+        La liste renvoyée est une copie ; les Trade sont partagés avec le store.
+        """
+        with self._lock:
+            if limit is None:
+                return list(self._trades)
+            return self._trades[-limit:]
+
+    def mark_dirty(self, trade: Trade) -> None:
+        """À appeler après avoir modifié un trade en place."""
+        with self._lock:
+            self._dirty_ids.add(trade.id)
+
+    def flush(self) -> None:
+        """Écrit en une transaction les trades modifiés depuis le dernier flush."""
+        with self._lock:
+            if not self._dirty_ids:
+                return
+            rows = [
+                (t.pair, t.side, dump_trade(t), t.id)
+                for t in self._trades
+                if t.id in self._dirty_ids
+            ]
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "UPDATE trades SET pair = ?, side = ?, data = ? WHERE id = ?", rows
+                )
+            self._dirty_ids.clear()
+
+
+STORE = TradeStore()
 
 
 # ---------- Utils parsing ----------
 
+# Au moins un chiffre garanti par le motif : chaque match est convertible en float
+_FLOAT_RE = re.compile(r"[-+]?\d*\.?\d+")
+
+
 def extract_floats(line: str) -> List[float]:
     """Récupère tous les nombres (float) dans une ligne, peu importe les espaces/virgules."""
-    txt = line.replace(",", ".")
-    matches = re.findall(r"[-+]?\d*\.?\d+", txt)
-    values: List[float] = []
-    for m in matches:
-        if m in ("", "+", "-", ".", "-."):
-            continue
-        try:
-            values.append(float(m))
-        except ValueError:
-            pass
-    return values
+    return [float(m) for m in _FLOAT_RE.findall(line.replace(",", "."))]
 
 
 # ---------- API prix (CoinGecko) ----------
@@ -104,14 +307,66 @@ COINGECKO_SYMBOL_MAP: Dict[str, str] = {
     "TON": "toncoin",
 }
 
-COINGECKO_DYNAMIC_MAP: Dict[str, str] = {}
+SEARCH_TTL = 3600     # secondes : une résolution /search est gardée 1h
+
+# symbole -> (id CoinGecko, timestamp epoch de la résolution)
+COINGECKO_DYNAMIC_MAP: Dict[str, Tuple[str, float]] = {}
+
+
+def load_coingecko_ids() -> None:
+    """Recharge depuis le disque les résolutions /search encore valides."""
+    if not os.path.exists(COINGECKO_IDS_FILE):
+        return
+    try:
+        with open(COINGECKO_IDS_FILE, "rb") as f:
+            data = json_loads(f.read())
+    except (OSError, ValueError):  # json/orjson.JSONDecodeError héritent de ValueError
+        return
+    if not isinstance(data, dict):
+        return
+
+    now = time.time()
+    for sym, entry in data.items():
+        # Entrée mal formée ou ancien format : ignorée, elle sera re-résolue via /search
+        try:
+            cg_id, resolved_at = entry
+            if isinstance(cg_id, str) and now - float(resolved_at) < SEARCH_TTL:
+                COINGECKO_DYNAMIC_MAP[sym] = (cg_id, float(resolved_at))
+        except (ValueError, TypeError):
+            continue
+
+
+def save_coingecko_ids() -> None:
+    """Écriture atomique (fichier temporaire + rename)."""
+    tmp = COINGECKO_IDS_FILE + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(COINGECKO_DYNAMIC_MAP, f, ensure_ascii=False)
+        os.replace(tmp, COINGECKO_IDS_FILE)
+    except OSError as e:
+        logger.warning("Impossible d'écrire %s : %s", COINGECKO_IDS_FILE, e)
+
+
+load_coingecko_ids()
+
+# Session partagée : keep-alive + réutilisation TLS vers api.coingecko.com
+CG_SESSION = requests.Session()
+CG_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=10,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]),
+    ),
+)
+CG_SESSION.headers.update({"User-Agent": "ulyssetif-bot/1.0"})
 
 
 def resolve_coingecko_id(symbol: str) -> str | None:
     """
     Résout un ticker (ex: 'BTC') vers un id CoinGecko (ex: 'bitcoin').
     1) map statique
-    2) map dynamique
+    2) map dynamique (valable SEARCH_TTL secondes, persistée sur disque)
     3) API /search
     """
     sym = symbol.upper()
@@ -119,17 +374,18 @@ def resolve_coingecko_id(symbol: str) -> str | None:
     if sym in COINGECKO_SYMBOL_MAP:
         return COINGECKO_SYMBOL_MAP[sym]
 
-    if sym in COINGECKO_DYNAMIC_MAP:
-        return COINGECKO_DYNAMIC_MAP[sym]
+    cached = COINGECKO_DYNAMIC_MAP.get(sym)
+    if cached and time.time() - cached[1] < SEARCH_TTL:
+        return cached[0]
 
     try:
         url = "https://api.coingecko.com/api/v3/search"
-        resp = requests.get(url, params={"query": sym}, timeout=5)
-        data = resp.json()
+        resp = CG_SESSION.get(url, params={"query": sym}, timeout=5)
+        data = json_loads(resp.content)
         coins = data.get("coins", [])
 
         if not coins:
-            print(f"[!] CoinGecko search: aucun résultat pour le symbole {sym}")
+            logger.warning("CoinGecko search: aucun résultat pour le symbole %s", sym)
             return None
 
         best_id = None
@@ -144,49 +400,81 @@ def resolve_coingecko_id(symbol: str) -> str | None:
             best_id = coins[0].get("id")
 
         if not best_id:
-            print(f"[!] CoinGecko search: impossible de déterminer un id pour {sym} -> {coins}")
+            logger.warning("CoinGecko search: impossible de déterminer un id pour %s -> %s", sym, coins)
             return None
 
-        COINGECKO_DYNAMIC_MAP[sym] = best_id
-        print(f"[+] CoinGecko mapping auto: {sym} -> {best_id}")
+        COINGECKO_DYNAMIC_MAP[sym] = (best_id, time.time())
+        save_coingecko_ids()
+        logger.info("CoinGecko mapping auto: %s -> %s", sym, best_id)
         return best_id
 
     except Exception as e:
-        print(f"[!] Erreur CoinGecko search pour {sym} : {e}")
+        logger.warning("Erreur CoinGecko search pour %s : %s", sym, e)
         return None
 
 
-def get_price_for_pair(pair: str) -> float | None:
+def get_prices_for_ids(cg_ids: List[str]) -> Dict[str, float]:
     """
-    Récupère le prix du coin via CoinGecko.
-    On suppose des paires du type 'BTC/USDT', 'SOL/USDT', etc.
-    On récupère le prix en USD et on l'utilise comme prix USDT (approximation suffisante).
+    Récupère en un seul appel /simple/price les prix USD de plusieurs ids CoinGecko.
+    Le prix USD est utilisé comme prix USDT (approximation suffisante).
+    Renvoie un dict id -> prix (les ids sans prix sont absents du résultat).
     """
-    try:
-        base = pair.split("/")[0].upper()  # 'BTC/USDT' -> 'BTC'
-        cg_id = resolve_coingecko_id(base)
-        if cg_id is None:
-            print(f"[!] CoinGecko: impossible de résoudre un id pour {base}")
-            return None
+    price_by_id: Dict[str, float] = {}
+    if not cg_ids:
+        return price_by_id
 
+    try:
         url = "https://api.coingecko.com/api/v3/simple/price"
-        params = {"ids": cg_id, "vs_currencies": "usd"}
-        resp = requests.get(url, params=params, timeout=5)
-        data = resp.json()
+        params = {"ids": ",".join(cg_ids), "vs_currencies": "usd"}
+        resp = CG_SESSION.get(url, params=params, timeout=5)
+        data = json_loads(resp.content)
+    except Exception as e:
+        logger.warning("Erreur API CoinGecko pour %s : %s", cg_ids, e)
+        return price_by_id
 
-        if cg_id not in data or "usd" not in data[cg_id]:
-            print(f"[!] CoinGecko: pas de prix trouvé pour {pair} (id={cg_id}) -> {data}")
-            return None
+    if not isinstance(data, dict):
+        logger.warning("CoinGecko: réponse inattendue pour %s -> %s", cg_ids, data)
+        return price_by_id
 
-        price_usd = float(data[cg_id]["usd"])
-        return price_usd  # 1 USDT ≈ 1 USD
+    for cg_id in cg_ids:
+        quote = data.get(cg_id)
+        try:
+            price = float(quote["usd"])  # 1 USDT ≈ 1 USD
+        except (KeyError, TypeError, ValueError):
+            logger.warning("CoinGecko: pas de prix trouvé pour id=%s -> %s", cg_id, data)
+            continue
+        price_by_id[cg_id] = price
+    return price_by_id
 
-    except Exception as e:
-        print(f"[!] Erreur API CoinGecko pour {pair} : {e}")
-        return None
+
+def get_prices_for_pairs(pairs: set[str]) -> Dict[str, float]:
+    """
+    Résout chaque paire vers son id CoinGecko puis récupère tous les prix
+    en un seul appel /simple/price. Renvoie un dict paire -> prix.
+    Une seule résolution par symbole de base ('BTC/USDT' et 'BTC/USDC' -> 'BTC').
+    Les paires non résolues sont absentes du résultat.
+    """
+    pair_to_base = {p: p.split("/")[0].upper() for p in pairs}
+    base_to_id = {b: resolve_coingecko_id(b) for b in set(pair_to_base.values())}
+    pair_to_id: Dict[str, str] = {
+        p: base_to_id[b] for p, b in pair_to_base.items() if base_to_id[b] is not None
+    }
+
+    price_by_id = get_prices_for_ids(sorted(set(pair_to_id.values())))
+    return {p: price_by_id[cg_id] for p, cg_id in pair_to_id.items() if cg_id in price_by_id}
 
 
-def update_trade_with_price(trade: Dict[str, Any], price: float) -> tuple[bool, str | None]:
+def levels_hit_mask(levels: List[float], price: float, price_below: bool) -> int:
+    """
+    Bitmask des niveaux atteints : bit i à 1 si price <= levels[i] (price_below)
+    ou si price >= levels[i] (sinon).
+    """
+    if price_below:
+        return sum(1 << i for i, v in enumerate(levels) if price <= v)
+    return sum(1 << i for i, v in enumerate(levels) if price >= v)
+
+
+def update_trade_with_price(trade: Trade, price: float) -> tuple[bool, str | None]:
     """
     Met à jour un trade en fonction du prix courant.
     - coche les PE touchées
@@ -194,41 +482,31 @@ def update_trade_with_price(trade: Dict[str, Any], price: float) -> tuple[bool,
     - Si TP1 touché pour la première fois, passe SL au BE automatiquement
     - renvoie (should_close, reason) -> si True, le trade est retiré de la liste
     """
-    side = str(trade.get("side", "")).upper()
-    entries: List[float] = trade.get("entries") or []
-    tps: List[float] = trade.get("tps") or []
-    sl = trade.get("sl", None)
+    side = trade.side.upper()
+    entries = trade.entries
+    tps = trade.tps
+    sl = trade.sl
 
-    hit_tps: List[int] = trade.get("hit_tps") or []
-    hit_entries: List[int] = trade.get("hit_entries") or []
+    # Bit i à 1 = PE / TP d'index i touché
+    hit_tps_mask = trade.hit_tps_mask
+    hit_entries_mask = trade.hit_entries_mask
 
-    # --- PE touchées ---
-    if side in ("LONG", "BUY"):
-        for i, e in enumerate(entries):
-            if i not in hit_entries and price <= e:
-                hit_entries.append(i)
-    elif side in ("SHORT", "SELL"):
-        for i, e in enumerate(entries):
-            if i not in hit_entries and price >= e:
-                hit_entries.append(i)
-
-    trade["hit_entries"] = hit_entries
+    tp1_was_hit = hit_tps_mask & 1  # État avant update
 
-    # --- TP touchées ---
-    tp1_was_hit = 0 in hit_tps  # État avant update
+    # --- PE / TP touchées : masque des niveaux atteints, OR dans l'existant ---
+    # LONG : PE touchée si prix <= PE, TP si prix >= TP ; SHORT : l'inverse
     if side in ("LONG", "BUY"):
-        for i, tp in enumerate(tps):
-            if i not in hit_tps and price >= tp:
-                hit_tps.append(i)
+        hit_entries_mask |= levels_hit_mask(entries, price, price_below=True)
+        hit_tps_mask |= levels_hit_mask(tps, price, price_below=False)
     elif side in ("SHORT", "SELL"):
-        for i, tp in enumerate(tps):
-            if i not in hit_tps and price <= tp:
-                hit_tps.append(i)
+        hit_entries_mask |= levels_hit_mask(entries, price, price_below=False)
+        hit_tps_mask |= levels_hit_mask(tps, price, price_below=True)
 
-    trade["hit_tps"] = hit_tps
+    trade.hit_entries_mask = hit_entries_mask
+    trade.hit_tps_mask = hit_tps_mask
 
     # --- Auto BE si TP1 touché pour la première fois ---
-    tp1_now_hit = 0 in hit_tps
+    tp1_now_hit = hit_tps_mask & 1
     if tp1_now_hit and not tp1_was_hit and sl is not None:
         # Calcul BE selon side
         be_price = None
@@ -237,13 +515,13 @@ def update_trade_with_price(trade: Dict[str, Any], price: float) -> tuple[bool,
                 be_price = max(entries)   # BE = entry la plus haute (long)
             elif side in ("SHORT", "SELL"):
                 be_price = min(entries)   # BE = entry la plus basse (short)
-        elif trade.get("entry") is not None:
-            be_price = trade["entry"]
+        elif trade.entry is not None:
+            be_price = trade.entry
 
         if be_price is not None:
-            trade["sl"] = be_price
-            trade["sl_note"] = "BE"
-            print(f"[*] SL auto passé au BE pour {trade.get('pair')} (TP1 touché, be={be_price})")
+            trade.sl = be_price
+            trade.sl_note = "BE"
+            logger.info("SL auto passé au BE pour %s (TP1 touché, be=%s)", trade.pair, be_price)
 
     # --- SL / full TP -> fermeture ---
     should_close = False
@@ -271,83 +549,130 @@ def update_trade_with_price(trade: Dict[str, Any], price: float) -> tuple[bool,
     return should_close, reason
 
 
+async def job_flush_trades(context: ContextTypes.DEFAULT_TYPE):
+    """Job périodique : écrit les trades sur disque s'ils ont changé."""
+    STORE.flush()
+
+
+async def on_shutdown(app: Application) -> None:
+    if _send_worker_task is not None:
+        _send_worker_task.cancel()
+    if _health_server is not None:
+        _health_server.close()
+    STORE.flush()
+
+
 async def job_check_prices(context: ContextTypes.DEFAULT_TYPE):
     """
     Job périodique : vérifie les prix, coche PE/TP, ferme les trades si SL ou TP final touché.
     """
-    trades = load_trades()
+    trades = STORE.get_open_trades()
     if not trades:
         return
 
-    price_cache: Dict[str, float] = {}
-    kept: List[Dict[str, Any]] = []
+    updated: List[Trade] = []
+    closed: List[Trade] = []
 
-    print("\n📊 --- Vérification automatique des prix ---")
+    logger.info("📊 Vérification automatique des prix (%d trades)", len(trades))
 
-    for t in trades:
-        pair = t.get("pair")
-        side = t.get("side", "?")
-        entries = t.get("entries") or [t.get("entry")]
-        sl = t.get("sl")
-        tps = t.get("tps") or []
+    # Appels HTTP bloquants (requests) dans un thread : la boucle PTB reste libre
+    pairs = {t.pair for t in trades if t.pair}
+    price_cache = await asyncio.to_thread(get_prices_for_pairs, pairs)
+    for pair in pairs - price_cache.keys():
+        logger.warning("❌ Impossible de récupérer le prix pour %s", pair)
+
+    debug = logger.isEnabledFor(logging.DEBUG)
 
+    for t in trades:
+        pair = t.pair
         if not pair:
-            kept.append(t)
             continue
 
-        if pair not in price_cache:
-            price = get_price_for_pair(pair)
-            if price is None:
-                print(f"[!] ❌ Impossible de récupérer le prix pour {pair}")
-                kept.append(t)
-                continue
-            price_cache[pair] = price
-        else:
-            price = price_cache[pair]
-
-        entries_str = ", ".join(str(e) for e in entries) if entries else "-"
-        tps_str = ", ".join(str(tp) for tp in tps) if tps else "-"
-
-        print(f"💰 {pair}: {price} | {side} | Entry(s): {entries_str} | SL: {sl} | TP(s): {tps_str}")
+        price = price_cache.get(pair)
+        if price is None:
+            continue  # paire non résolue / sans prix : trade conservé tel quel
+
+        if debug:
+            entries = t.entries or [t.entry]
+            logger.debug(
+                "💰 %s: %s | %s | Entry(s): %s | SL: %s | TP(s): %s",
+                pair,
+                price,
+                t.side or "?",
+                ", ".join(str(e) for e in entries) if entries else "-",
+                t.sl,
+                ", ".join(str(tp) for tp in t.tps) if t.tps else "-",
+            )
 
+        before = (t.hit_tps_mask, t.hit_entries_mask, t.sl, t.sl_note)
         should_close, reason = update_trade_with_price(t, price)
         if should_close:
             if reason:
-                print(f"[-] Trade fermé par prix ({pair}) au prix {price} – {reason}")
+                logger.info("Trade fermé par prix (%s) au prix %s – %s", pair, price, reason)
             else:
-                print(f"[-] Trade fermé par prix ({pair}) au prix {price}")
-        else:
-            kept.append(t)
+                logger.info("Trade fermé par prix (%s) au prix %s", pair, price)
+            closed.append(t)
+        elif (t.hit_tps_mask, t.hit_entries_mask, t.sl, t.sl_note) != before:
+            updated.append(t)  # seuls les trades réellement modifiés sont réécrits
 
-    save_trades(kept)
-    print("✅ Vérification terminée.")
+    # Un seul passage dans le store pour tout le tick (dirty + DELETE groupé)
+    STORE.apply_tick(updated, closed)
+    logger.info("✅ Vérification terminée (%d fermé(s)).", len(closed))
 
 
 # ---------- Mini serveur HTTP pour Render (healthcheck) ----------
 
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(b"OK")
+_HEALTH_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Length: 2\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"OK"
+)
 
-    # On supprime le log HTTP bruyant
-    def log_message(self, format, *args):
-        return
+_health_server: asyncio.AbstractServer | None = None
 
 
-def start_health_server():
-    """Petit serveur HTTP juste pour Render, ne renvoie que 'OK'."""
+async def _handle_health(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    # On lit (et ignore) la requête, puis on répond toujours 'OK'
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    try:
+        writer.write(_HEALTH_RESPONSE)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_health_server() -> None:
+    """Petit serveur HTTP juste pour Render, ne renvoie que 'OK' (dans la boucle asyncio de PTB)."""
+    global _health_server
     port = int(os.environ.get("PORT", "10000"))
-    server = HTTPServer(("0.0.0.0", port), HealthHandler)
-    print(f"[health] HTTP server listening on port {port}")
-    server.serve_forever()
+    _health_server = await asyncio.start_server(_handle_health, "0.0.0.0", port)
+    logger.info("[health] HTTP server listening on port %d", port)
 
 
 # ---------- Parsing des calls ----------
 
-def parse_trade_message(text: str, message_id: int) -> Dict[str, Any] | None:
+_SIDES = frozenset({"LONG", "SHORT", "BUY", "SELL"})
+_ENTRY_PREFIXES = ("entry", "entrée", "entree", "pe")
+_TP_RE = re.compile(r"tp(\d+)")  # champ 'tpN' de /edit
+
+# Pré-filtre PTB : un call a forcément un sens (LONG/SHORT/...) puis une ligne SL.
+# Les messages avec le smiley cerveau 🧠 ne doivent pas créer de trade.
+_CALL_RE = re.compile(r"(?is)\b(?:LONG|SHORT|BUY|SELL)\b.*\bSL")
+CALL_FILTER = (
+    (filters.Regex(_CALL_RE) | filters.CaptionRegex(_CALL_RE))
+    & ~(filters.Regex("🧠") | filters.CaptionRegex("🧠"))
+)
+
+
+def parse_trade_message(text: str, message_id: int) -> Trade | None:
     """
     Essaye de détecter un call de manière assez large.
 
@@ -382,18 +707,17 @@ def parse_trade_message(text: str, message_id: int) -> Dict[str, Any] | None:
     if len(tokens) < 2:
         return None
 
-    sides = {"LONG", "SHORT", "BUY", "SELL"}
-    side = None
-    pair = None
+    t0u = tokens[0].upper()
+    t1u = tokens[1].upper()
 
     # Cas : LONG BTC/USDT
-    if tokens[0].upper() in sides:
-        side = tokens[0].upper()
-        pair = tokens[1].upper()
+    if t0u in _SIDES:
+        side = t0u
+        pair = t1u
     # Cas : XRP SHORT
-    elif tokens[1].upper() in sides:
-        side = tokens[1].upper()
-        pair = tokens[0].upper()
+    elif t1u in _SIDES:
+        side = t1u
+        pair = t0u
     else:
         return None
 
@@ -413,7 +737,7 @@ def parse_trade_message(text: str, message_id: int) -> Dict[str, Any] | None:
         if not nums:
             continue
 
-        if lower.startswith(("entry", "entrée", "entree", "pe")):
+        if lower.startswith(_ENTRY_PREFIXES):
             if entries is None:
                 entries = nums
 
@@ -428,40 +752,122 @@ def parse_trade_message(text: str, message_id: int) -> Dict[str, Any] | None:
         return None
 
     entry_main = entries[0]
-
-    trade = {
-        "origin_message_id": message_id,
-        "pair": pair,
-        "side": side,
-        "entry": entry_main,
-        "entries": entries,
-        "sl": sl,
-        "tps": tps,
-        "hit_tps": [],
-        "hit_entries": [],
-        "sl_note": "",
-        "created_at": datetime.now(timezone.utc).isoformat(),
-    }
-    return trade
+    now = datetime.now(timezone.utc)
+
+    return Trade(
+        origin_message_id=message_id,
+        pair=pair,
+        side=side,
+        entry=entry_main,
+        entries=entries,
+        sl=sl,
+        tps=tps,
+        created_at=now.isoformat(),
+        created_at_display=now.strftime(CREATED_DISPLAY_FORMAT),
+    )
 
 
 # ---------- Helpers droits ----------
 
+ADMIN_TTL = 60  # secondes : le statut admin change rarement
+
+# (chat_id, user_id) -> (statut du membre, time.monotonic() de la vérification)
+_ADMIN_CACHE: Dict[Tuple[int, int], Tuple[str, float]] = {}
+
+
 async def user_is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Vérifie si l'utilisateur est admin du chat où il utilise la commande."""
+    """
+    Vérifie si l'utilisateur est admin du chat où il utilise la commande.
+    Le statut est mis en cache ADMIN_TTL secondes par (chat, utilisateur).
+    """
     chat = update.effective_chat
     user = update.effective_user
     if not chat or not user:
         return False
 
-    member = await context.bot.get_chat_member(chat.id, user.id)
-    return member.status in ("administrator", "creator")
+    key = (chat.id, user.id)
+    cached = _ADMIN_CACHE.get(key)
+    if cached and time.monotonic() - cached[1] < ADMIN_TTL:
+        status = cached[0]
+    else:
+        member = await context.bot.get_chat_member(chat.id, user.id)
+        status = member.status
+        _ADMIN_CACHE[key] = (status, time.monotonic())
+
+    return status in ("administrator", "creator")
+
+
+# ---------- Envoi des messages (file + rate limit) ----------
+
+TELEGRAM_MAX_LEN = 4000      # limite Telegram : 4096 caractères, on garde une marge
+SEND_INTERVAL = 1 / 25       # au plus ~25 messages/s (limite bot : 30/s)
+
+_send_queue: "asyncio.Queue[Tuple[int, str, int | None]]" = asyncio.Queue()
+_send_worker_task: asyncio.Task | None = None
+
+
+def split_message(blocks: List[str], limit: int = TELEGRAM_MAX_LEN) -> List[str]:
+    """
+    Regroupe les blocs (séparés par une ligne vide) en messages de `limit` caractères max.
+    Un bloc trop long à lui seul est coupé brutalement.
+    """
+    chunks: List[str] = []
+    current = ""
+    for block in blocks:
+        while len(block) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(block[:limit])
+            block = block[limit:]
+        if not current:
+            current = block
+        elif len(current) + 2 + len(block) <= limit:
+            current += "\n\n" + block
+        else:
+            chunks.append(current)
+            current = block
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def enqueue_message(chat_id: int, text: str, reply_to: int | None = None) -> None:
+    """Met un message dans la file d'envoi (envoyé par send_worker)."""
+    await _send_queue.put((chat_id, text, reply_to))
+
+
+async def send_worker(bot: Bot) -> None:
+    """Envoie les messages de la file un par un, espacés de SEND_INTERVAL."""
+    while True:
+        chat_id, text, reply_to = await _send_queue.get()
+        try:
+            try:
+                await bot.send_message(chat_id, text, reply_to_message_id=reply_to)
+            except RetryAfter as e:
+                logger.warning("Flood control Telegram : attente %ss", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+                await bot.send_message(chat_id, text, reply_to_message_id=reply_to)
+        except Exception as e:
+            logger.warning("Envoi Telegram impossible vers %s : %s", chat_id, e)
+        finally:
+            _send_queue.task_done()
+        await asyncio.sleep(SEND_INTERVAL)
+
+
+async def on_startup(app: Application) -> None:
+    global _send_worker_task
+    _send_worker_task = asyncio.create_task(send_worker(app.bot))
+    await start_health_server()
 
 
 # ---------- Handlers Telegram ----------
 
 async def handle_announce(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Reçoit les messages du canal d'annonces, détecte les nouveaux calls uniquement."""
+    """
+    Reçoit les messages du canal d'annonces, détecte les nouveaux calls uniquement.
+    Seuls les messages qui passent CALL_FILTER arrivent ici (forme de call, sans 🧠).
+    """
     message = update.effective_message
     if message.chat_id != ANNOUNCE_CHANNEL_ID:
         return
@@ -470,105 +876,91 @@ async def handle_announce(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         return
 
-    # Vérification du smiley cerveau : si présent, on ignore pour ajouter un trade
-    if '🧠' in text:
-        print(f"[!] Message ignoré pour parsing trade (contient 🧠) : '{text[:50]}...'")
-        return
-
     # On essaie de parser un nouveau call
     trade = parse_trade_message(text, message_id=message.message_id)
     if trade:
-        add_trade(trade)
-        print(
-            f"[+] Nouveau trade enregistré : {trade['side']} {trade['pair']} | "
-            f"entries={trade['entries']} | tps={trade['tps']}"
+        STORE.add_trade(trade)
+        logger.info(
+            "Nouveau trade enregistré : %s %s | entries=%s | tps=%s",
+            trade.side, trade.pair, trade.entries, trade.tps,
         )
 
 
+TRADES_DISCLAIMER = (
+    "⚠️ Attention : les données affichées ici sont gérées par un bot. "
+    "En cas de doute, référez-vous en priorité au canal annonces, car des erreurs sont possibles."
+)
+
+
+def _marked(label: str, values: List[Any], mask: int) -> str:
+    """'PE1: 2.4 ✅ | PE2: 3.1' : ✅ sur les index dont le bit est à 1 dans mask."""
+    return " | ".join(
+        f"{label}{i}: {v} ✅" if (mask >> (i - 1)) & 1 else f"{label}{i}: {v}"
+        for i, v in enumerate(values, start=1)
+    )
+
+
+def render_trade_block(idx: int, t: Trade) -> str:
+    """Bloc texte d'un trade pour /trades."""
+    entries = t.entries or [t.entry]
+    sl = t.sl
+    tps = t.tps
+    hit_entries_mask = t.hit_entries_mask
+    sl_note = t.sl_note
+    created = t.created_at_display
+
+    # Entrées (PE) avec ✅ si touchées
+    if len(entries) == 1:
+        mark = " ✅" if hit_entries_mask & 1 else ""
+        entries_line = f"🏁 Entry : {entries[0]}{mark}"
+    else:
+        entries_line = "🏁 " + _marked("PE", entries, hit_entries_mask)
+
+    # SL
+    if sl is None:
+        sl_line = "🛡 SL : ?"
+    elif sl_note:
+        sl_line = f"🛡 SL : {sl} ({sl_note})"
+    else:
+        sl_line = f"🛡 SL : {sl}"
+
+    # TP : on affiche TP1, TP2... avec ✅ si atteint
+    tp_line = "🎯 " + _marked("TP", tps, t.hit_tps_mask) if tps else "🎯 TP : -"
+
+    block = (
+        f"📊 Trade #{idx}\n"
+        f"{t.pair or '?'} – {t.side or '?'}\n"
+        f"{entries_line}\n"
+        f"{sl_line}\n"
+        f"{tp_line}"
+    )
+
+    # Date (optionnel)
+    if created:
+        block += f"\n⏱ Créé : {created} UTC"
+
+    return block
+
+
 async def cmd_trades(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Affiche les trades ouverts, format joli (accessible à tout le monde)."""
     chat = update.effective_chat
     if not chat or chat.id != DISCUSSION_CHAT_ID:
         return  # 🔒 on ne répond qu'au canal discussion
 
-    trades = get_open_trades(limit=20)
+    reply_to = update.message.message_id
+    trades = STORE.get_open_trades(limit=20)
     if not trades:
-        await update.message.reply_text(
-            "📭 Aucun trade ouvert pour le moment.\n\n"
-            "⚠️ Attention : les données affichées ici sont gérées par un bot. "
-            "En cas de doute, référez-vous en priorité au canal annonces, car des erreurs sont possibles."
+        await enqueue_message(
+            chat.id, "📭 Aucun trade ouvert pour le moment.\n\n" + TRADES_DISCLAIMER, reply_to
         )
         return
 
-    blocks = []
-    for idx, t in enumerate(trades, start=1):
-        pair = t.get("pair", "?")
-        side = t.get("side", "?")
-        entries = t.get("entries") or [t.get("entry")]
-        sl = t.get("sl")
-        tps = t.get("tps") or []
-        hit_tps: List[int] = t.get("hit_tps") or []
-        hit_entries: List[int] = t.get("hit_entries") or []
-        sl_note = t.get("sl_note", "")
-        created = t.get("created_at")
-
-        # Entrées (PE) avec ✅ si touchées
-        if len(entries) == 1:
-            mark = " ✅" if 0 in hit_entries else ""
-            entries_line = f"🏁 Entry : {entries[0]}{mark}"
-        else:
-            parts = []
-            for i, e in enumerate(entries, start=1):
-                mark = " ✅" if (i - 1) in hit_entries else ""
-                parts.append(f"PE{i}: {e}{mark}")
-            entries_line = "🏁 " + " | ".join(parts)
-
-        # SL
-        if sl is not None:
-            if sl_note:
-                sl_line = f"🛡 SL : {sl} ({sl_note})"
-            else:
-                sl_line = f"🛡 SL : {sl}"
-        else:
-            sl_line = "🛡 SL : ?"
-
-        # TP : on affiche TP1, TP2... avec ✅ si atteint
-        if tps:
-            tp_parts = []
-            for i, value in enumerate(tps, start=1):
-                mark = " ✅" if (i - 1) in hit_tps else ""
-                tp_parts.append(f"TP{i}: {value}{mark}")
-            tp_line = "🎯 " + " | ".join(tp_parts)
-        else:
-            tp_line = "🎯 TP : -"
-
-        # Date (optionnel)
-        created_line = ""
-        if created:
-            try:
-                dt = created.split(".")[0].replace("T", " ")
-                created_line = f"⏱ Créé : {dt} UTC"
-            except Exception:
-                pass
-
-        block_lines = [
-            f"📊 Trade #{idx}",
-            f"{pair} – {side}",
-            entries_line,
-            sl_line,
-            tp_line,
-        ]
-        if created_line:
-            block_lines.append(created_line)
-
-        blocks.append("\n".join(block_lines))
-
-    text = "\n\n".join(blocks)
-    text += (
-        "\n\n⚠️ Attention : les données affichées ici sont gérées par un bot. "
-        "En cas de doute, référez-vous en priorité au canal annonces, car des erreurs sont possibles."
-    )
-    await update.message.reply_text(text)
+    blocks = [render_trade_block(idx, t) for idx, t in enumerate(trades, start=1)]
+    blocks.append(TRADES_DISCLAIMER)
+    # Découpage aux frontières de blocs ; seul le premier message répond à la commande
+    for i, chunk in enumerate(split_message(blocks)):
+        await enqueue_message(chat.id, chunk, reply_to if i == 0 else None)
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -603,12 +995,12 @@ async def cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     args = context.args
     if not args:
-        clear_all_trades()
+        STORE.clear_all_trades()
         await update.message.reply_text("🧹 Tous les trades ont été supprimés.")
         return
 
     symbol = args[0]
-    removed = clear_trades_by_symbol(symbol)
+    removed = STORE.clear_trades_by_symbol(symbol)
     if removed == 0:
         await update.message.reply_text(f"ℹ️ Aucun trade trouvé pour '{symbol.upper()}'.")
     else:
@@ -622,7 +1014,7 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
       /edit BTC sl 102458
       /edit BTC tp1 106453
 
-    - Cherche le DERNIER trade dont la paire contient 'BTC'
+    - Cherche le DERNIER trade de base 'BTC' (à défaut, dont la paire contient 'BTC')
     - sl  : met à jour la SL (sans afficher 'edited'), et enlève éventuellement la note BE
     - tpN : met à jour TPN et reset les ✅ sur TP
     """
@@ -644,7 +1036,7 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     symbol = args[0].upper()
-    field = args[1].lower()
+    field_name = args[1].lower()
     value_raw = args[2]
 
     # Conversion en float
@@ -654,38 +1046,28 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Valeur invalide : {value_raw}")
         return
 
-    trades = load_trades()
-    target_index = None
-
     # On prend le DERNIER trade qui matche le symbole (comme "plus récent")
-    for i in range(len(trades) - 1, -1, -1):
-        pair = str(trades[i].get("pair", "")).upper()
-        if symbol in pair:
-            target_index = i
-            break
-
-    if target_index is None:
+    trade = STORE.find_last_by_symbol(symbol)
+    if trade is None:
         await update.message.reply_text(f"ℹ️ Aucun trade trouvé pour '{symbol}'.")
         return
 
-    trade = trades[target_index]
-    pair_label = trade.get("pair", "?")
+    pair_label = trade.pair or "?"
 
     # Édition de la SL
-    if field == "sl":
-        trade["sl"] = new_value
+    if field_name == "sl":
+        trade.sl = new_value
         # si une note existait (ex: 'BE'), on l'enlève quand on modifie la SL à la main
-        trade["sl_note"] = ""
-        trades[target_index] = trade
-        save_trades(trades)
+        trade.sl_note = ""
+        STORE.mark_dirty(trade)
         await update.message.reply_text(
             f"✏️ SL mise à jour pour {pair_label} : {new_value}."
         )
         return
 
     # Édition d'un TP : tp1, tp2, ...
-    if field.startswith("tp"):
-        m = re.match(r"tp(\d+)", field)
+    if field_name.startswith("tp"):
+        m = _TP_RE.match(field_name)
         if not m:
             await update.message.reply_text(
                 "❌ Champ non supporté. Utilise 'sl' ou 'tp1', 'tp2', ..."
@@ -697,7 +1079,7 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Index de TP invalide.")
             return
 
-        tps: List[float] = trade.get("tps") or []
+        tps = trade.tps
 
         # Étend la liste si besoin
         if tp_index < len(tps):
@@ -708,12 +1090,10 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 tps.append(new_value)
             tps.append(new_value)
 
-        trade["tps"] = tps
         # On reset les TP touchés pour que les ✅ soient recalculées sur les nouvelles valeurs
-        trade["hit_tps"] = []
+        trade.hit_tps_mask = 0
 
-        trades[target_index] = trade
-        save_trades(trades)
+        STORE.mark_dirty(trade)
 
         await update.message.reply_text(
             f"✏️ TP{tp_index + 1} mis à jour pour {pair_label} : {new_value}.\n"
@@ -730,18 +1110,31 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def main():
-    app = Application.builder().token(TOKEN).build()
+    logging.basicConfig(
+        level=os.getenv("LOGLEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    # httpx (utilisé par PTB) logue chaque requête de polling en INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(on_startup)  # file d'envoi + healthcheck HTTP pour Render
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # ✅ Job de vérification des prix toutes les 60 secondes (1 minute, commence après 10s)
     app.job_queue.run_repeating(job_check_prices, interval=60, first=10)
 
-    # 🧠 On démarre le mini serveur HTTP pour Render dans un thread séparé
-    threading.Thread(target=start_health_server, daemon=True).start()
+    # 💾 Écriture disque groupée des trades toutes les 5 secondes (si modifiés)
+    app.job_queue.run_repeating(job_flush_trades, interval=5, first=5)
 
     # Messages du canal d'annonces (uniquement ce canal, et pas les commandes)
     app.add_handler(
         MessageHandler(
-            filters.Chat(ANNOUNCE_CHANNEL_ID) & (~filters.COMMAND),
+            filters.Chat(ANNOUNCE_CHANNEL_ID) & (~filters.COMMAND) & CALL_FILTER,
             handle_announce
         )
     )
@@ -752,7 +1145,7 @@ def main():
     app.add_handler(CommandHandler("clear", cmd_clear))
     app.add_handler(CommandHandler("edit", cmd_edit))
 
-    print("Bot lancé...")
+    logger.info("Bot lancé...")
     app.run_polling()
 
 